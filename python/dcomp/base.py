@@ -4,7 +4,6 @@ from abc import ABCMeta, abstractmethod
 import json
 import logging
 import traceback
-from six import add_metaclass
 
 from .utils import load_default_drush, load_default_config, load_default_services, get_class, read_properties
 
@@ -46,10 +45,7 @@ class DRecord(object):
             return {k: v for k, v in self.__dict__.items()}
 
 
-# Python3 style: class DSite(metaclass=ABCMeta). Python2 style __metaclass__ = ABCMeta
-# this is "six" style, using decoration.
-@add_metaclass(ABCMeta)
-class DSite(object):
+class DSite(metaclass=ABCMeta):
     """ Models the base class for all Drupal site. """
 
     def check_connection(self):
@@ -90,8 +86,7 @@ class DSite(object):
         pass
 
 
-@add_metaclass(ABCMeta)
-class DSiteExtended(object):
+class DSiteExtended(metaclass=ABCMeta):
 
     @abstractmethod
     def get_variable(self, name, default=None): pass
@@ -236,8 +231,7 @@ class DServicesSite(DSite):
 
 # DCommand doesn't need "with" because everything is handled within "execute()". We don't need extra enter/exit,
 # which would be confusing in terms of what should be done in "execute() and what should be done in "enter/exit".
-@add_metaclass(ABCMeta)
-class DCommand(object):
+class DCommand(metaclass=ABCMeta):
     """ The base class for all Drupal Computing command that focuses on executing program logic. """
 
     def __init__(self):
@@ -271,8 +265,7 @@ class DCommandExecutionException(Exception):
         self.message = message
 
 
-@add_metaclass(ABCMeta)
-class DApplication(object):
+class DApplication(metaclass=ABCMeta):
     """ This class defines a Drupal Computing application. Use with "with". """
 
     def __init__(self, app_name):
@@ -1,22 +1,121 @@
 """ Utilities to use with Drupal. """
 
+import io
 import os
+import queue
 import subprocess
 import sys
 import socket
+import threading
+import uuid
 import re
 import logging
 import json
-import six
-import six.moves.urllib.request as urllib_request
-import six.moves.urllib.parse as urllib_parse
+from functools import lru_cache
+from importlib import import_module
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 __author__ = 'Daniel Zhou'
 
 
+# use orjson for the JSON hot path (drush pipe output, services bodies) if it's installed.
+if orjson is not None:
+    def _json_loads(s):
+        return orjson.loads(s)
+
+    def _json_dumpb(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+else:
+    def _json_loads(s):
+        return json.loads(s)
+
+    def _json_dumpb(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def _json_dumps(obj):
+        return json.dumps(obj)
+
+
+def _walk_items(obj, path):
+    """ Yield values at "path" (ijson prefix syntax, e.g. "nodes.item.title") from an already decoded JSON object. """
+    if not path:
+        yield obj
+        return
+    head, _, rest = path.partition('.')
+    if head == 'item' and isinstance(obj, list):
+        for child in obj:
+            for value in _walk_items(child, rest):
+                yield value
+    elif isinstance(obj, dict) and head in obj:
+        for value in _walk_items(obj[head], rest):
+            yield value
+
+
+def _extract_field(raw, path):
+    """
+    Get the first value at "path" from the raw JSON document. Nested paths are parsed incrementally with ijson (if
+    installed) and stop as soon as the field is found, instead of building the whole result.
+    :param raw: the JSON document, str or bytes.
+    :param path: ijson style prefix, eg "sessid", "user.name", "item.nid".
+    :return: the value, or None if not found.
+    """
+    if '.' not in path or ijson is None:
+        return next(_walk_items(_json_loads(raw), path), None)
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    return next(ijson.items(io.BytesIO(raw), path, use_float=True), None)
+
+
+@lru_cache(maxsize=256)
+def _env_key(key):
+    """ Map a config key to its environment variable name, eg "dcomp.exec.timeout" => "DCOMP_EXEC_TIMEOUT". """
+    return key.replace('.', '_').upper()
+
+
+@lru_cache(maxsize=1)
+def _hostname():
+    return socket.gethostname()
+
+
+def _php_string(s):
+    """ Quote "s" as a PHP single-quoted string literal. """
+    return "'%s'" % s.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def _php_call(func_name, args_json):
+    """ Build the PHP expression that calls Drupal function "func_name" with "args_json", the JSON list of arguments. """
+    return 'call_user_func_array(%s, json_decode(%s, TRUE))' % (_php_string(func_name), _php_string(args_json))
+
+
+def _has_dict(value):
+    """
+    Whether "value" is or contains a dict. Drush computing-call and json_decode(..., TRUE) are not known to pass dicts
+    (eg. DRecord fields) to Drupal functions the same way, so such arguments always go through computing-call.
+    """
+    if isinstance(value, dict):
+        return True
+    if isinstance(value, (list, tuple)):
+        return any(_has_dict(item) for item in value)
+    return False
+
+
 class DConfig(object):
     """ This class helps read configurations for Drupal python agent. """
 
+    __slots__ = ('properties', '_exec_timeout')
+
     def __init__(self, filename=None):
         """
         Load settings from "filename" if given, or load settings from config.properties
@@ -26,6 +125,7 @@ class DConfig(object):
         from . import __version__
         logging.info('Drupal Computing agent library version: %s' % __version__)
         self.properties = {}
+        self._exec_timeout = None
 
         if filename is None:
             filename = self.get('dcomp.config.file', 'config.properties')
@@ -46,12 +146,18 @@ class DConfig(object):
         result = self.properties.get(key, None)
         # 2. or try to get from system settings.
         if result is None:
-            env_key = key.replace('.', '_').upper()
-            result = os.getenv(env_key, None)
+            result = os.getenv(_env_key(key), None)
         return result if result is not None else value
 
     def set(self, key, value):
         self.properties[key] = value
+        self._exec_timeout = None
+
+    def get_exec_timeout(self):
+        """ Returns "dcomp.exec.timeout" in seconds. The setting itself is in milliseconds. """
+        if self._exec_timeout is None:
+            self._exec_timeout = int(self.get('dcomp.exec.timeout', 120000)) / 1000.0
+        return self._exec_timeout
 
     def get_drush_command(self):
         return self.get('dcomp.drush.command', 'drush')
@@ -61,101 +167,258 @@ class DConfig(object):
 
     def get_agent_name(self):
         name = self.get('dcomp.agent.name')
-        return name if name is not None else socket.gethostname()
+        return name if name is not None else _hostname()
 
 
 _default_config = None
+_default_config_lock = threading.Lock()
 
 
 def load_default_config(reload=False):
     """ Load configurations from config.properties. """
     global _default_config
-    # lazy initialization
+    # lazy initialization. double-checked locking so that concurrent first uses create only one object.
     if _default_config is None or reload:
-        _default_config = DConfig()
+        with _default_config_lock:
+            if _default_config is None or reload:
+                if reload:
+                    _read_properties.cache_clear()
+                _default_config = DConfig()
     return _default_config
 
 
+# computing_call() arguments larger than this (in bytes of UTF-8 encoded JSON) are sent through stdin instead of argv.
+_ARGV_JSON_LIMIT = 4096
+
+# PHP loop run by the long-lived drush process of DDrush.open_session(). It reads one JSON request {"id", "code"} per
+# line and evaluates the code in its own function scope, so the code can't touch the loop's variables and no variables
+# carry over between calls, same as one-shot computing-eval. Output printed by the code is discarded. The reply is
+# written on its own line as '<marker> <id> ok <JSON of the returned value>' or '<marker> <id> error <JSON of the
+# exception message>', so that other output (eg. PHP notices or drush warnings outside the output buffer) can be told
+# apart and skipped.
+_DRUSH_SESSION_LOOP = '$__dcomp_run = function ($__dcomp_code) { return eval($__dcomp_code); }; ' \
+                      'while (($__dcomp_line = fgets(STDIN)) !== FALSE) { ' \
+                      '$__dcomp_request = json_decode($__dcomp_line, TRUE); $__dcomp_id = $__dcomp_request["id"]; ' \
+                      'ob_start(); ' \
+                      'try { $__dcomp_reply = "ok " . json_encode($__dcomp_run($__dcomp_request["code"])); } ' \
+                      'catch (Exception $e) { $__dcomp_reply = "error " . json_encode($e->getMessage()); } ' \
+                      'catch (Throwable $e) { $__dcomp_reply = "error " . json_encode($e->getMessage()); } ' \
+                      'ob_end_clean(); echo "\\n", %s, " ", $__dcomp_id, " ", $__dcomp_reply, "\\n"; flush(); }'
+
+
+class _DrushSession(object):
+    """ The long-lived drush process behind DDrush.open_session(). """
+
+    __slots__ = ('proc', 'marker', 'last_id', 'replies')
+
+    def __init__(self, all_args):
+        # a random marker, so that replies can't be confused with anything else printed on stdout.
+        self.marker = '__DCOMP_REPLY_%s__' % uuid.uuid4().hex
+        self.last_id = 0
+        self.replies = queue.Queue()
+        all_args = all_args + ['php-eval', _DRUSH_SESSION_LOOP % _php_string(self.marker)]
+        self.proc = subprocess.Popen(all_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        # read stdout in a thread, so that waiting for a reply can time out.
+        threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def _read_replies(self):
+        for line in self.proc.stdout:
+            if line.startswith(self.marker + ' '):
+                self.replies.put(line.rstrip('\n'))
+            elif line.strip():
+                logging.warning('Unexpected output from drush session: %s' % line.rstrip())
+        # EOF: the process has exited.
+        self.replies.put(None)
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def kill(self):
+        """ Kill the process if it's still running, and return its exit code. """
+        if self.proc.poll() is None:
+            self.proc.kill()
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        return self.proc.wait()
+
+    def close(self, timeout):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def evaluate(self, code, timeout):
+        self.last_id += 1
+        try:
+            self.proc.stdin.write(_json_dumps({'id': self.last_id, 'code': code}) + '\n')
+            self.proc.stdin.flush()
+        except OSError:
+            # the process has exited since the last call.
+            raise subprocess.CalledProcessError(self.kill(), self.proc.args)
+
+        try:
+            reply = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            self.kill()
+            raise subprocess.TimeoutExpired(self.proc.args, timeout)
+        if reply is None:
+            raise subprocess.CalledProcessError(self.kill(), self.proc.args)
+
+        parts = reply.split(' ', 3)
+        if len(parts) != 4 or parts[1] != str(self.last_id) or parts[2] not in ('ok', 'error'):
+            # replies are out of sync. the process can't be trusted anymore.
+            returncode = self.kill()
+            raise subprocess.CalledProcessError(returncode, self.proc.args, output=reply)
+        if parts[2] == 'error':
+            # a PHP exception. the process is still usable.
+            raise subprocess.CalledProcessError(1, self.proc.args, output=_json_loads(parts[3]))
+        return parts[3]
+
+
 class DDrush(object):
     """ Helper class to access Drush. """
 
+    __slots__ = ('drush_command', 'site_alias', '_session')
+
     def __init__(self, drush_command, site_alias):
         self.drush_command = drush_command
         self.site_alias = site_alias
+        self._session = None
 
-    def execute(self, extra_args=[], input_string=None):
+    def execute(self, extra_args=None, input_string=None):
         """
         This does not handle possible exceptions. Caller functions should take care of them.
-        :except: CalledProcessError, TimeExpired
+        :except: CalledProcessError, TimeoutExpired
         """
-        config = load_default_config()
-        timeout = int(config.get('dcomp.exec.timeout', 120000))
+        # the parsed timeout is cached by the config object, so it follows load_default_config(reload=True).
+        timeout = load_default_config().get_exec_timeout()
 
         all_args = [self.drush_command, self.site_alias]
         if extra_args is not None:
             all_args.extend(extra_args)
 
         # TODO: handle error output and exceptions.
-        if six.PY3 and sys.version_info[1] >= 4:
-            return subprocess.check_output(all_args, input=input_string, universal_newlines=True, timeout=timeout)
-
-        elif six.PY3:
-            # six.PY3 == True and sys.version_info[1] < 4
-            # copied and modified from python3.4, subprocess.py source code
-            with subprocess.Popen(all_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True) as process:
-                try:
-                    if sys.version_info[1] >= 3:
-                        # python3.3 supports timeout.
-                        output, unused_err = process.communicate(input=input_string, timeout=timeout)
-                    else:
-                        output, unused_err = process.communicate(input=input_string)
-                except:
-                    process.kill()
-                    process.wait()
-                    raise
-                retcode = process.poll()
-                if retcode:
-                    raise subprocess.CalledProcessError(retcode, process.args, output=output)
-            return output
-
-        elif six.PY2:
-            # python2 Popen doesn't support "with"
-            process = subprocess.Popen(all_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
-            try:
-                output, unused_err = process.communicate(input_string)
-            except:
-                process.kill()
-                process.wait()
-                raise
-            retcode = process.poll()
-            if retcode:
-                raise subprocess.CalledProcessError(retcode, process.args, output=output)
-            # in lower version of python, output is bytes
-            return str(output)
+        return subprocess.run(all_args, input=input_string, stdout=subprocess.PIPE, text=True, timeout=timeout, check=True).stdout
 
-        else:
-            assert False
+    def execute_many(self, arg_lists, max_workers=8, input_strings=None):
+        """
+        Run several drush processes in parallel, so their Drupal bootstrap and I/O waits overlap.
+        :param arg_lists: list of "extra_args" for execute().
+        :param input_strings: optional list of "input_string" for execute(), aligned with "arg_lists".
+        :return: list of outputs in the same order as "arg_lists".
+        :except: the first CalledProcessError or TimeoutExpired raised, in the order of "arg_lists". ValueError if
+            "input_strings" and "arg_lists" have different lengths.
+        """
+        if input_strings is not None and len(input_strings) != len(arg_lists):
+            raise ValueError('input_strings has %d items but arg_lists has %d.' % (len(input_strings), len(arg_lists)))
+
+        # import here so that agents not running drush in parallel don't pay for loading it.
+        from concurrent.futures import ThreadPoolExecutor
+
+        if input_strings is None:
+            input_strings = [None] * len(arg_lists)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.execute, arg_lists, input_strings))
+
+    def open_session(self):
+        """
+        Start one long-lived drush process so that Drupal bootstraps only once. While the session is open,
+        computing_call() and computing_eval() run in it instead of spawning drush each time. Not thread-safe.
+        Note that Drupal's static caches (eg. entity_load()/node_load()) stay alive for the whole session, so results
+        can be stale compared with one-shot calls.
+        """
+        if self._session is None:
+            self._session = _DrushSession([self.drush_command, self.site_alias])
+
+    def close_session(self):
+        if self._session is not None:
+            session, self._session = self._session, None
+            session.close(load_default_config().get_exec_timeout())
+
+    def has_session(self):
+        return self._session is not None
+
+    def execute_in_session(self, code):
+        """
+        Evaluate PHP code in the drush process started by open_session().
+        :param code: PHP code, eg 'return node_load(1);'
+        :return: the JSON string of the returned value.
+        :except: CalledProcessError if the code raised an exception, or if the drush process exited (eg. because of a
+            PHP fatal error) or got out of sync, which also closes the session. TimeoutExpired if the code runs longer
+            than "dcomp.exec.timeout", which kills the process and closes the session.
+        """
+        assert self._session is not None
+        session = self._session
+        try:
+            return session.evaluate(code, load_default_config().get_exec_timeout())
+        finally:
+            if not session.is_alive() and self._session is session:
+                self._session = None
 
     def computing_call_raw(self, func_name, *args):
-        calls = ['computing-call', '--pipe', func_name]
-        for arg in args:
-            calls.append(json.dumps(arg))
-        return self.execute(calls)
+        if self._session is not None and not _has_dict(args):
+            return self.execute_in_session('return %s;' % _php_call(func_name, _json_dumps(list(args))))
+        return self.execute(*self._computing_call_command(func_name, args))
+
+    def _computing_call_command(self, func_name, args):
+        """ Returns (extra_args, input_string) of execute() to run a computing call in a new drush process. """
+        json_args = [_json_dumps(arg) for arg in args]
+        if sum(len(json_arg.encode('utf-8')) for json_arg in json_args) > _ARGV_JSON_LIMIT and not _has_dict(args):
+            # send large arguments through stdin with computing-eval rather than argv, which is capped by ARG_MAX.
+            return ['computing-eval', '--pipe', '-'], 'return %s;' % _php_call(func_name, '[%s]' % ','.join(json_args))
+        return ['computing-call', '--pipe', func_name] + json_args, None
 
     def computing_call(self, func_name, *args):
         json_result = self.computing_call_raw(func_name, *args)
-        return json.loads(json_result)
+        return _json_loads(json_result)
+
+    def computing_call_field(self, func_name, json_path, *args):
+        """
+        Same as computing_call(), but only extract one field from the result.
+        :param json_path: ijson style prefix of the field, eg "name", or "roles.item" for the first item of "roles".
+        :return: the field value, or None if not found.
+        """
+        return _extract_field(self.computing_call_raw(func_name, *args), json_path)
+
+    def computing_call_batch(self, calls):
+        """
+        Execute several Drupal functions in one single drush process, so Drupal bootstraps only once for all of them.
+        :param calls: list of (func_name, args) tuples, eg [('node_load', [1]), ('variable_get', ['site_name'])].
+        :return: list of results in the same order as "calls".
+        :except: ValueError if any argument is or contains a dict, use computing_call() for those.
+        """
+        if len(calls) == 0:
+            return []
+        if any(_has_dict(args) for _, args in calls):
+            raise ValueError('computing_call_batch() does not support dict arguments.')
+        code = 'return array(%s);' % ', '.join(_php_call(func_name, _json_dumps(list(args))) for func_name, args in calls)
+        return self.computing_eval(code)
+
+    def computing_call_many(self, calls, max_workers=8):
+        """
+        Execute several Drupal functions in parallel drush processes. See execute_many().
+        :param calls: list of (func_name, args) tuples, eg [('node_load', [1]), ('node_load', [2])].
+        :return: list of results in the same order as "calls".
+        """
+        commands = [self._computing_call_command(func_name, args) for func_name, args in calls]
+        outputs = self.execute_many([extra_args for extra_args, _ in commands], max_workers, [input_string for _, input_string in commands])
+        return [_json_loads(output) for output in outputs]
 
     def computing_eval_raw(self, code):
+        if self._session is not None:
+            return self.execute_in_session(code)
         eval_args = ['computing-eval', '--pipe', '-']
         return self.execute(eval_args, code)
 
     def computing_eval(self, code):
         json_result = self.computing_eval_raw(code)
-        return json.loads(json_result)
+        return _json_loads(json_result)
 
     def get_core_status(self):
-        return json.loads(self.execute(["core-status", "--pipe", "--format=json"]))
+        return _json_loads(self.execute(["core-status", "--pipe", "--format=json"]))
 
     def get_drush_string(self):
         return "%s %s" % (self.drush_command, self.site_alias)
@@ -165,22 +428,51 @@ class DDrush(object):
 
 
 _default_drush = None
+_default_drush_lock = threading.Lock()
 
 
 def load_default_drush(reload=False):
     """ Load DDrush() object using the settings in config.properties. """
     global _default_drush
-    # lazy initialization
+    # lazy initialization with double-checked locking, see load_default_config().
     if _default_drush is None or reload:
-        config = load_default_config()
-        _default_drush = DDrush(config.get_drush_command(), config.get_drush_site_alias())
+        with _default_drush_lock:
+            if _default_drush is None or reload:
+                config = load_default_config()
+                _default_drush = DDrush(config.get_drush_command(), config.get_drush_site_alias())
     return _default_drush
 
 
+_http_adapter = None
+_http_adapter_lock = threading.Lock()
+
+
+def _get_http_adapter():
+    """ Returns the HTTP connection pool shared by all DRestfulJsonServices objects, so the socket count stays bounded. """
+    global _http_adapter
+    # lazy initialization with double-checked locking, see load_default_config().
+    if _http_adapter is None:
+        with _http_adapter_lock:
+            if _http_adapter is None:
+                # import here so that agents only using drush or configs don't pay for loading the HTTP libraries.
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                # only idempotent requests are retried on read errors; connection errors are retried for all methods.
+                _http_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=100, max_retries=Retry(total=3, backoff_factor=0.5))
+    return _http_adapter
+
+
 class DRestfulJsonServices(object):
     """ Helper class to access Drpual Services module endpoints. """
 
-    def __init__(self, base_url, endpoint, username, password):
+    __slots__ = ('base_url', 'endpoint', 'username', 'password', 'services_link', 'services_session_token',
+                 'http_user_agent', 'http_content_type', 'session', '_body_headers')
+
+    def __init__(self, base_url, endpoint, username, password, session=None):
+        """
+        :param session: optional requests.Session to use. By default each object has its own session (and cookies),
+            sharing the connection pool with other DRestfulJsonServices objects.
+        """
         self.base_url = base_url.strip()
         # remove left '/' if any
         self.endpoint = endpoint.strip().lstrip('/')
@@ -193,81 +485,91 @@ class DRestfulJsonServices(object):
         self.http_user_agent = 'DrupalComputingAgent'
         self.http_content_type = 'application/json'
 
-        # set cookie handler
-
-        # first, create an opener than has cookie support.
-        opener = urllib_request.build_opener(urllib_request.HTTPCookieProcessor())
-        # then install the opener to request instead of using the default BaseHandler.
-        urllib_request.install_opener(opener)
+        # the session keeps connections alive and handles cookies for us.
+        if session is None:
+            import requests
+            session = requests.Session()
+            session.mount('http://', _get_http_adapter())
+            session.mount('https://', _get_http_adapter())
+        self.session = session
+        # constant headers are set once on the session; only requests with a body add 'Content-Type'.
+        self.session.headers.update({'User-Agent': self.http_user_agent, 'Accept': self.http_content_type})
+        self._body_headers = {'Content-Type': self.http_content_type}
 
     def request(self, directive, params, method):
+        """ Make request to Drupal services and decode the JSON response. See request_raw(). """
+        return _json_loads(self.request_raw(directive, params, method))
+
+    def request_raw(self, directive, params, method):
         """ Make request to Drupal services.
         See https://www.drupal.org/node/783254 for a list of RESTful directives.
         :param directive: eg system/connect.json, node/1.json, variable_get.json, etc.
         :param params: data in python {}
         :param method: GET, POST, PUT, DELETE, etc.
-        :return: the JSON object from Drupal services.
-        :exception: HTTPError
+        :return: the raw JSON response from Drupal services, in bytes.
+        :exception: requests.HTTPError
         """
+        # JSON decoders take UTF-8 bytes directly, so skip building an intermediate str.
+        return self._send(directive, params, method).content
 
-        data = None
-        link = "%s/%s" % (self.services_link, directive)
-
-        if method == 'GET':
-            if params is not None:
-                query_string = urllib_parse.urlencode(params)
-                link = "%s?%s" % (link, query_string)
-
-        elif method == 'POST' or method == 'PUT':
-            if params is not None:
-                data = json.dumps(params).encode('utf-8')
+    def request_stream(self, directive, params, method, item_path='item'):
+        """
+        Make request to Drupal services and yield the JSON items at "item_path" as they are parsed from the response,
+        so large responses (eg node/index.json) don't have to be held in memory all at once. Parsing is incremental
+        only if ijson is installed; otherwise the whole response is decoded first.
+        :param item_path: ijson style prefix of the items, eg "item" for a top-level list, or "nodes.item".
+        :return: generator of the items.
+        :exception: requests.HTTPError
+        """
+        with self._send(directive, params, method, stream=True) as response:
+            if ijson is None:
+                items = _walk_items(_json_loads(response.content), item_path)
+            else:
+                response.raw.decode_content = True
+                items = ijson.items(response.raw, item_path, use_float=True)
+            for item in items:
+                yield item
+
+    def _send(self, directive, params, method, stream=False):
+        data, headers = None, None
+        link = f"{self.services_link}/{directive}"
+
+        if method in ('POST', 'PUT') and params is not None:
+            data = _json_dumpb(params)
+            headers = self._body_headers
 
         # process request
         logging.info('Making connection to: %s' % link)
-        headers = {'User-Agent': self.http_user_agent, 'Accept': self.http_content_type}
-        if data is not None:
-            headers['Content-Type'] = self.http_content_type
-            # I assume 'Content-Length' is handled in urllib_request.Request
-            # header['Content-Length'] = len(data)
-        if self.services_session_token is not None:
-            headers['X-CSRF-Token'] = self.services_session_token
-
-        logging.debug('Data: %s. Headers: %s. Method: %s' % (str(data), str(headers), method))
-
-        if six.PY3 and sys.version_info[1] >= 3:
-            request = urllib_request.Request(link, data=data, headers=headers, method=method)
-        else:
-            # http://stackoverflow.com/questions/4511598/how-to-make-http-delete-method-using-urllib2
-            request = urllib_request.Request(link, data=data, headers=headers)
-            request.get_method = lambda: method
+        logging.debug('Data: %s. Method: %s' % (str(data), method))
 
         # this is the actually connection.
-        response = urllib_request.urlopen(request)
-
-        raw_content = response.read()
-        return json.loads(raw_content.decode('utf-8'))
+        response = self.session.request(method, link, params=params if method == 'GET' else None, data=data, headers=headers, stream=stream)
+        response.raise_for_status()
+        return response
 
     def check_connection(self):
         """
         Check connection to Drupal Services.
         :return: True if connection successful, or False.
         """
-        result = self.request('system/connect.json', None, 'POST')
-        logging.info("Checking connection to '%s/system/connect.json' returns: %s" % (self.services_link, json.dumps(result)))
-        return True if 'sessid' in result and len(result['sessid']) > 0 else False
+        raw_result = self.request_raw('system/connect.json', None, 'POST')
+        logging.info("Checking connection to '%s/system/connect.json' returns: %s" % (self.services_link, raw_result.decode('utf-8', 'replace')))
+        sessid = _extract_field(raw_result, 'sessid')
+        return True if sessid is not None and len(sessid) > 0 else False
 
     def is_authenticated(self):
         return self.services_session_token is not None
 
     def obtain_session_token(self):
         link = "%s/services/session/token" % self.base_url
-        return urllib_request.urlopen(link).read().decode('utf-8')
+        return self.session.get(link).text
 
     def user_login(self):
         params = {'username': self.username, 'password': self.password}
         result = self.request('user/login.json', params, 'POST')
         if 'token' in result and len(result['token']) > 0:
             self.services_session_token = result['token']
+            self.session.headers['X-CSRF-Token'] = self.services_session_token
             logging.info('User login successful: %s' % self.username)
         else:
             logging.error('User login failed: %s' % self.username)
@@ -275,31 +577,41 @@ class DRestfulJsonServices(object):
     def user_logout(self):
         result = self.request('user/logout.json', None, 'POST')
         self.services_session_token = None
+        self.session.headers.pop('X-CSRF-Token', None)
         logging.info('User logout successful: %s' % self.username)
 
 
 _default_services = None
+_default_services_lock = threading.Lock()
 
 
 def load_default_services(reload=False):
     """ Load DRestfulJsonServices() object using the settings in config.properties. """
     global _default_services
-    # lazy initialization
+    # lazy initialization with double-checked locking, see load_default_config().
     if _default_services is None or reload:
-        config = load_default_config()
-        base_url = config.get('dcomp.site.base_url')
-        endpoint = config.get('dcomp.services.endpoint')
-        username = config.get('dcomp.services.user.name')
-        password = config.get('dcomp.services.user.pass')
-        if base_url is None or not base_url.startswith('http') or endpoint is None or username is None or password is None:
-            logging.warning('Services configuration problem. Connection to Drupal Services is not guaranteed.')
-        # initialize services.
-        _default_services = DRestfulJsonServices(base_url, endpoint, username, password)
+        with _default_services_lock:
+            if _default_services is None or reload:
+                config = load_default_config()
+                base_url = config.get('dcomp.site.base_url')
+                endpoint = config.get('dcomp.services.endpoint')
+                username = config.get('dcomp.services.user.name')
+                password = config.get('dcomp.services.user.pass')
+                if base_url is None or not base_url.startswith('http') or endpoint is None or username is None or password is None:
+                    logging.warning('Services configuration problem. Connection to Drupal Services is not guaranteed.')
+                # initialize services.
+                _default_services = DRestfulJsonServices(base_url, endpoint, username, password)
     return _default_services
 
 
 def check_python_version():
-    return sys.version_info[0] >= 3 or (sys.version_info[0] >= 2 and sys.version_info[1] >= 7)
+    return sys.version_info >= (3, 7)
+
+
+# splits a properties line in one left-to-right pass: the key runs up to the first unescaped '=', ':' or whitespace,
+# followed by an optional separator surrounded by whitespace, and the rest is the value.
+_PROPERTY_LINE_RE = re.compile(r'((?:\\.|[^\\=:\s])*)\s*[=:]?\s*(.*)')
+_KEY_ESCAPE_RE = re.compile(r'\\(.)')
 
 
 def read_properties(filename):
@@ -310,95 +622,46 @@ def read_properties(filename):
     :param filename: the java properties file.
     :return: dict object of the properties.
     """
+    # the parsed result is cached per file version, so return a copy that callers are free to modify.
+    path = os.path.abspath(filename)
+    return dict(_read_properties(path, os.stat(path).st_mtime_ns))
 
-    def unescape(value):
-        newvalue = value.replace('\:',':')
-        newvalue = newvalue.replace('\=','=')
-        return newvalue
-
-    props, keymap, origprops = {}, {}, {}
 
-    with open(filename) as f:
-        lines = f.readlines()
-
-    othercharre = re.compile(r'(?<!\\)(\s*\=)|(?<!\\)(\s*\:)')
-    othercharre2 = re.compile(r'(\s*\=)|(\s*\:)')
-    bspacere = re.compile(r'\\(?!\s$)')
-
-    lineno=0
-    i = iter(lines)
-    for line in i:
-        lineno += 1
-        line = line.strip()
-        if not line: continue
-        if line[0] == '#' or line[0] == ';': continue
-        escaped = False
-        sepidx = -1
-        flag = 0
-        m = othercharre.search(line)
-        if m:
-            first, last = m.span()
-            start, end = 0, first
-            flag = 1
-            wspacere = re.compile(r'(?<![\\\=\:])(\s)')
-        else:
-            if othercharre2.search(line):
-                wspacere = re.compile(r'(?<![\\])(\s)')
-            start, end = 0, len(line)
-
-        m2 = wspacere.search(line, start, end)
-        if m2:
-            first, last = m2.span()
-            sepidx = first
-        elif m:
-            first, last = m.span()
-            sepidx = last - 1
-
-        while line[-1] == '\\':
-            nextline = i.next()
-            nextline = nextline.strip()
-            lineno += 1
-            line = line[:-1] + nextline
-
-        if sepidx != -1:
-            key, value = line[:sepidx], line[sepidx+1:]
-        else:
-            key, value = line, ''
-
-        oldkey = key
-        oldvalue = value
-        keyparts = bspacere.split(key)
-
-        strippable = False
-        lastpart = keyparts[-1]
-
-        if lastpart.find('\\ ') != -1:
-            keyparts[-1] = lastpart.replace('\\','')
-
-        elif lastpart and lastpart[-1] == ' ':
-            strippable = True
+@lru_cache(maxsize=8)
+def _read_properties(filename, mtime_ns):
+    """
+    Parse the java properties file. Configurations rarely change during the process lifetime, so cache it.
+    "mtime_ns" is only part of the cache key, so that an edited file is read again.
+    """
 
-        key = ''.join(keyparts)
-        if strippable:
-            key = key.strip()
-            oldkey = oldkey.strip()
+    def unescape(value):
+        newvalue = value.replace(r'\:', ':')
+        newvalue = newvalue.replace(r'\=', '=')
+        return newvalue
 
-        oldvalue = unescape(oldvalue)
-        value = unescape(value)
+    def logical_lines(f):
+        """ Yield non-empty, non-comment lines, joining lines continued with a trailing backslash. """
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            if line[0] == '#' or line[0] == ';': continue
+            # an odd number of trailing backslashes continues the line; an even number is escaped backslashes.
+            while (len(line) - len(line.rstrip('\\'))) % 2 == 1:
+                line = line[:-1] + next(f, '').strip()
+            yield line
 
-        props[key] = value.strip()
+    props = {}
 
-        if key in keymap:
-            oldkey = keymap.get(key)
-            origprops[oldkey] = oldvalue.strip()
-        else:
-            origprops[oldkey] = oldvalue.strip()
-            keymap[key] = oldkey
+    with open(filename) as f:
+        for line in logical_lines(f):
+            key, value = _PROPERTY_LINE_RE.match(line).groups()
+            props[_KEY_ESCAPE_RE.sub(r'\1', key)] = unescape(value).strip()
 
     # return the dict
     return props
 
 
+@lru_cache(maxsize=None)
 def get_class(class_name):
     """
     This function gets the class from a string "class_name".
@@ -406,14 +669,10 @@ def get_class(class_name):
     :param class_name: the string of the class name
     :return: the "class" object so you can instantiate it.
     """
-    parts = class_name.split('.')
-    if len(parts) > 1:
+    module, _, name = class_name.rpartition('.')
+    if module:
         # that is, we need to import the module first.
-        module = ".".join(parts[:-1])
-        m = __import__(module)
-        for comp in parts[1:]:
-            m = getattr(m, comp)
-        return m
+        return getattr(import_module(module), name)
     else:
         # assuming the class is already in scope
-        return getattr(sys.modules['__main__'], class_name)
\ No newline at end of file
+        return getattr(sys.modules['__main__'], class_name)
@@ -1,23 +1,246 @@
 from pprint import pprint
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
-import six.moves.urllib.error as urllib_error
+import requests
 
 from dcomp.utils import *
+from dcomp.utils import _extract_field, _walk_items, _php_string, _php_call, _ARGV_JSON_LIMIT
+import dcomp.utils
 from dcomp.base import *
 
 
+# a stand-in for drush, used with DDrush(sys.executable, <this script>). In "php-eval" mode it mimics the session loop of
+# DDrush.open_session() for a few canned PHP snippets, and prints stray output like PHP notices would. Otherwise it
+# prints its arguments and stdin as JSON, or exits with N if one argument is "failN".
+FAKE_DRUSH = r'''
+import json, re, sys, time
+args = sys.argv[1:]
+if args[0] != 'php-eval':
+    for arg in args:
+        if arg.startswith('fail'):
+            sys.exit(int(arg[4:]))
+    print(json.dumps({'args': args, 'stdin': sys.stdin.read() if '-' in args else None}))
+    sys.exit(0)
+
+marker = re.search(r"'(__DCOMP_REPLY_\w+__)'", args[1]).group(1)
+# PHP variables. the code shares them with the loop unless the loop runs it in a function of its own.
+isolated = 'function ($__dcomp_code)' in args[1]
+loop_scope = {}
+print('PHP Warning: printed by settings.php')
+sys.stdout.flush()
+for line in sys.stdin:
+    loop_scope['request'] = json.loads(line)
+    code = loop_scope['request']['code']
+    code_scope = {} if isolated else loop_scope
+    if code.startswith('print; '):
+        print('PHP Notice: printed outside the output buffer', end='')
+        code = code[len('print; '):]
+    # assignments, eg '$request = 7; return 8;'
+    m = re.match(r'\$(\w+) = ([^;]*); (.*)$', code)
+    while m:
+        code_scope[m.group(1)] = json.loads(m.group(2))
+        code = m.group(3)
+        m = re.match(r'\$(\w+) = ([^;]*); (.*)$', code)
+    if not isinstance(loop_scope['request'], dict):
+        # PHP fatal error: cannot use a scalar value as an array.
+        sys.exit(255)
+    request_id = loop_scope['request']['id']
+    if code == 'exit;':
+        sys.exit(255)
+    elif code == 'sleep;':
+        time.sleep(30)
+    elif code == 'throw;':
+        reply = 'error ' + json.dumps('boom')
+    elif code == 'desync;':
+        request_id += 1
+        reply = 'ok null'
+    else:
+        m = re.match(r"return call_user_func_array\('(\w+)', json_decode\('(.*)', TRUE\)\);$", code)
+        if m:
+            reply = 'ok ' + json.dumps([m.group(1), json.loads(re.sub(r"\\(['\\])", r'\1', m.group(2)))])
+        else:
+            value = re.match(r'return (.*);$', code).group(1)
+            reply = 'ok ' + (json.dumps(code_scope.get(value[1:])) if value.startswith('$') else value)
+    print('\n%s %d %s' % (marker, request_id, reply))
+    sys.stdout.flush()
+'''
+
+
 class TestUtils(unittest.TestCase):
 
+    def createFakeDrush(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as f:
+            f.write(FAKE_DRUSH)
+        self.addCleanup(os.remove, f.name)
+        return DDrush(sys.executable, f.name)
+
     def testMisc(self):
         self.assertTrue(check_python_version())
 
+    def testExtractField(self):
+        raw = '{"sessid": "abc", "user": {"name": "admin", "roles": ["authenticated", "administrator"]}}'
+        self.assertEquals('abc', _extract_field(raw, 'sessid'))
+        self.assertEquals('admin', _extract_field(raw.encode('utf-8'), 'user.name'))
+        self.assertEquals('authenticated', _extract_field(raw, 'user.roles.item'))
+        self.assertEquals(None, _extract_field(raw, 'user.mail'))
+
+        # the fallback used when ijson is not installed.
+        doc = {'nodes': [{'nid': '1'}, {'nid': '2'}], 'item': {'nid': '3'}}
+        self.assertEquals(['1', '2'], list(_walk_items(doc, 'nodes.item.nid')))
+        self.assertEquals(['3'], list(_walk_items(doc, 'item.nid')))
+        self.assertEquals([doc], list(_walk_items(doc, '')))
+
+    def testReadProperties(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.properties', delete=False) as f:
+            f.write('# comment \\\n')
+            f.write('; another comment\n')
+            f.write('dcomp.drush.site = @local\n')
+            f.write('dcomp.site.base_url=http\\://example.com\n')
+            f.write('dcomp.agent.name = james.\\\n')
+            f.write('    bond.007\n')
+            f.write('dcomp.site.access services\n')
+            f.write('dcomp.debug\n')
+            f.write('my\\ key = 1\n')
+            f.write('a\\=b = 2\n')
+            f.write('dcomp.database.url = jdbc:mysql://localhost/test\n')
+            f.write('tab\t=\tx\n')
+            f.write('dcomp.path = C:\\\\\n')
+            f.write('dcomp.next = 3\n')
+        try:
+            props = read_properties(f.name)
+            # edited files are read again, not served from the cache.
+            with open(f.name, 'a') as f2:
+                f2.write('dcomp.exec.timeout = 1000\n')
+            st = os.stat(f.name)
+            os.utime(f.name, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            self.assertEquals('1000', read_properties(f.name).get('dcomp.exec.timeout'))
+        finally:
+            os.remove(f.name)
+        self.assertEquals({'dcomp.drush.site': '@local', 'dcomp.site.base_url': 'http://example.com', 'dcomp.agent.name': 'james.bond.007',
+                           'dcomp.site.access': 'services', 'dcomp.debug': '', 'my key': '1', 'a=b': '2',
+                           'dcomp.database.url': 'jdbc:mysql://localhost/test', 'tab': 'x',
+                           'dcomp.path': 'C:\\\\', 'dcomp.next': '3'}, props)
+
     def testConfig(self):
         config = load_default_config()
         self.assertEquals(None, config.get('xoxo'))
         self.assertEquals('drush', config.get_drush_command())
+        self.assertEquals(120.0, DConfig('no-such-file.properties').get_exec_timeout())
+        config2 = DConfig('no-such-file.properties')
+        config2.set('dcomp.exec.timeout', '500')
+        self.assertEquals(0.5, config2.get_exec_timeout())
         print(config.get_agent_name())
 
 
+    def testComputingCallCommand(self):
+        # PHP single-quoted strings only escape ' and \\.
+        self.assertEquals("'it\\'s \\\\ ok'", _php_string("it's \\ ok"))
+        self.assertEquals("call_user_func_array('f', json_decode('[\"a\\'b\"]', TRUE))", _php_call('f', '["a\'b"]'))
+
+        drush = self.createFakeDrush()
+        small = 'x' * (_ARGV_JSON_LIMIT - 10)
+        extra_args, input_string = drush._computing_call_command('variable_get', [small])
+        self.assertEquals(['computing-call', '--pipe', 'variable_get', '"%s"' % small], extra_args)
+        self.assertIsNone(input_string)
+
+        # the limit is in bytes, so non-ASCII text goes through stdin with fewer characters.
+        for large in ('x' * _ARGV_JSON_LIMIT, '\u00e9' * (_ARGV_JSON_LIMIT // 2)):
+            extra_args, input_string = drush._computing_call_command('variable_get', [large])
+            self.assertEquals(['computing-eval', '--pipe', '-'], extra_args)
+            self.assertTrue(input_string.startswith("return call_user_func_array('variable_get', json_decode('[\""))
+
+        # arguments with quotes, backslashes and non-ASCII text, through argv and stdin.
+        arg = "it's \\ \u00e9t\u00e9"
+        self.assertEquals(['computing-call', '--pipe', 'f', '1', '"it\'s \\\\ \u00e9t\u00e9"'], drush.computing_call('f', 1, arg)['args'])
+        result = drush.computing_call('f', arg, 'x' * _ARGV_JSON_LIMIT)
+        self.assertEquals(['computing-eval', '--pipe', '-'], result['args'])
+        self.assertIn(_php_string('[' + ','.join(['"it\'s \\\\ \u00e9t\u00e9"', '"%s"' % ('x' * _ARGV_JSON_LIMIT)]) + ']'), result['stdin'])
+
+        # dict arguments always go through computing-call, even when large; batches reject them.
+        extra_args, input_string = drush._computing_call_command('computing_finish', [1, 'SCF', None, {'data': [{'x': small}, small]}])
+        self.assertEquals(['computing-call', '--pipe', 'computing_finish'], extra_args[:3])
+        self.assertIsNone(input_string)
+        self.assertRaises(ValueError, drush.computing_call_batch, [('f', [1]), ('computing_update', [{'id': 1}])])
+
+    def testDrushMany(self):
+        drush = self.createFakeDrush()
+        outputs = drush.execute_many([['status', str(i)] for i in range(10)], max_workers=4)
+        self.assertEquals([['status', str(i)] for i in range(10)], [json.loads(output)['args'] for output in outputs])
+        self.assertEquals([], drush.execute_many([]))
+        self.assertRaises(ValueError, drush.execute_many, [['status'], ['status']], input_strings=['x'])
+
+        results = drush.computing_call_many([('f', [1]), ('g', ['x' * _ARGV_JSON_LIMIT]), ('h', [])])
+        self.assertEquals(['computing-call', '--pipe', 'f', '1'], results[0]['args'])
+        self.assertEquals(['computing-eval', '--pipe', '-'], results[1]['args'])
+        self.assertEquals(['computing-call', '--pipe', 'h'], results[2]['args'])
+
+        # the first failure in the order of the arguments is raised.
+        try:
+            drush.execute_many([['status'], ['fail3'], ['fail4']])
+            self.assertTrue(False)
+        except subprocess.CalledProcessError as e:
+            self.assertEquals(3, e.returncode)
+
+    def testDrushSession(self):
+        drush = self.createFakeDrush()
+        drush.open_session()
+        self.addCleanup(drush.close_session)
+        self.assertTrue(drush.has_session())
+
+        # stray output before and between replies doesn't shift the results.
+        self.assertEquals(1, drush.computing_eval('return 1;'))
+        self.assertEquals(2, drush.computing_eval('print; return 2;'))
+        self.assertEquals(3, drush.computing_eval('return 3;'))
+        self.assertEquals(['node_load', [1, "it's \\ \u00e9"]], drush.computing_call('node_load', 1, "it's \\ \u00e9"))
+        # dict arguments skip the session and go through computing-call.
+        extra_args = drush.computing_call('computing_update', {'id': 1})['args']
+        self.assertEquals(['computing-call', '--pipe', 'computing_update'], extra_args[:3])
+        self.assertEquals([{'id': 1}], [json.loads(arg) for arg in extra_args[3:]])
+        self.assertTrue(drush.has_session())
+
+        # the code runs in its own scope: it can't break the loop, and variables don't carry over between calls.
+        self.assertEquals(8, drush.computing_eval('$request = 7; return 8;'))
+        self.assertEquals(9, drush.computing_eval('$y = 9; return $y;'))
+        self.assertIsNone(drush.computing_eval('return $y;'))
+        self.assertTrue(drush.has_session())
+
+        # PHP exceptions keep the session.
+        self.assertRaises(subprocess.CalledProcessError, drush.computing_eval, 'throw;')
+        self.assertTrue(drush.has_session())
+        self.assertEquals({'a': 4}, drush.computing_eval('return {"a": 4};'))
+
+        # the process exited during the call, or before the call.
+        self.assertRaises(subprocess.CalledProcessError, drush.computing_eval, 'exit;')
+        self.assertFalse(drush.has_session())
+        drush.open_session()
+        drush._session.proc.kill()
+        drush._session.proc.wait()
+        self.assertRaises(subprocess.CalledProcessError, drush.computing_eval, 'return 5;')
+        self.assertFalse(drush.has_session())
+
+        # replies out of sync.
+        drush.open_session()
+        self.assertRaises(subprocess.CalledProcessError, drush.computing_eval, 'desync;')
+        self.assertFalse(drush.has_session())
+
+        # timeout.
+        drush.open_session()
+        load_default_config().set('dcomp.exec.timeout', '500')
+        try:
+            self.assertRaises(subprocess.TimeoutExpired, drush.computing_eval, 'sleep;')
+        finally:
+            load_default_config(reload=True)
+        self.assertFalse(drush.has_session())
+
+        drush.open_session()
+        self.assertEquals(6, drush.computing_eval('return 6;'))
+        drush.close_session()
+        self.assertFalse(drush.has_session())
+
     def testDrush(self):
         drush = load_default_drush()
         config = load_default_config()
@@ -37,6 +260,33 @@ class TestUtils(unittest.TestCase):
         var1 = drush.computing_eval('return variable_get("install_profile");')
         self.assertEquals('standard', var1)
 
+        # batch calls return results in the order of the calls, same as single calls.
+        batch = drush.computing_call_batch([('variable_get', ['install_profile']), ('node_load', [1]), ('time', [])])
+        self.assertEquals(3, len(batch))
+        self.assertEquals(drush.computing_call('variable_get', 'install_profile'), batch[0])
+        self.assertEquals(node1, batch[1])
+        self.assertTrue(batch[2] > 0 and batch[2] <= drush.computing_call('time'))
+        self.assertEquals([], drush.computing_call_batch([]))
+
+        # same results with a drush session.
+        drush.open_session()
+        try:
+            self.assertTrue(drush.has_session())
+            self.assertEquals(node1, drush.computing_call('node_load', 1))
+            self.assertEquals(var1, drush.computing_eval('return variable_get("install_profile");'))
+            self.assertEquals(batch[:2], drush.computing_call_batch([('variable_get', ['install_profile']), ('node_load', [1])]))
+        finally:
+            drush.close_session()
+        self.assertFalse(drush.has_session())
+
+    def testServicesCookies(self):
+        # each services object keeps its own login cookies.
+        s1 = DRestfulJsonServices('http://example.com', 'endpoint', 'scott', 'tiger')
+        s2 = DRestfulJsonServices('http://example.com', 'endpoint', 'james', 'bond')
+        s1.session.cookies.set('SESSabc', 'foo')
+        self.assertEquals('foo', s1.session.cookies.get('SESSabc'))
+        self.assertIsNone(s2.session.cookies.get('SESSabc'))
+
     def testServices(self):
         services = load_default_services()
         # test connection
@@ -47,8 +297,8 @@ class TestUtils(unittest.TestCase):
         try:
             pprint(services.request('system/get_variable.json', {'name': 'install_profile'}, 'POST'))
             self.assertTrue(False)
-        except urllib_error.HTTPError as e:
-            self.assertEquals(403, e.code)
+        except requests.HTTPError as e:
+            self.assertEquals(403, e.response.status_code)
 
         # test login
         services.user_login()
@@ -60,6 +310,17 @@ class TestUtils(unittest.TestCase):
         n1 = services.request('node/1.json', None, 'GET')
         self.assertEquals('1', n1['nid'])
 
+        # streamed items are the same as the fully decoded response, with or without ijson.
+        nodes = services.request('node.json', None, 'GET')
+        self.assertTrue(len(nodes) > 0)
+        self.assertEquals(nodes, list(services.request_stream('node.json', None, 'GET')))
+        self.assertEquals([n['nid'] for n in nodes], list(services.request_stream('node.json', None, 'GET', 'item.nid')))
+        ijson_module, dcomp.utils.ijson = dcomp.utils.ijson, None
+        try:
+            self.assertEquals(nodes, list(services.request_stream('node.json', None, 'GET')))
+        finally:
+            dcomp.utils.ijson = ijson_module
+
         # test logout
         services.user_logout()
         self.assertFalse(services.is_authenticated())
@@ -120,6 +381,15 @@ class TestUtils(unittest.TestCase):
         self.assertEqual('SCF', r6.status)
         self.assertEqual('works', r6.message)
 
+        # dict fields larger than the argv limit.
+        large_output = {'message': 'x' * _ARGV_JSON_LIMIT, 'items': [{'\u00e9': i} for i in range(3)]}
+        r6.output = large_output
+        site.update_record_field(r6, 'output')
+        self.assertEqual(large_output, site.load_record(r6.id).output)
+        r6.output = {'message': 'y' * _ARGV_JSON_LIMIT}
+        site.finish_record(r6)
+        self.assertEqual({'message': 'y' * _ARGV_JSON_LIMIT}, site.load_record(r6.id).output)
+
         # claim not exist
         r6 = site.claim_record('foobar')
         self.assertIsNone(r6)
@@ -166,6 +436,15 @@ class TestUtils(unittest.TestCase):
         self.assertEqual('SCF', r6.status)
         self.assertEqual('works', r6.message)
 
+        # dict fields larger than the argv limit.
+        large_output = {'message': 'x' * _ARGV_JSON_LIMIT, 'items': [{'\u00e9': i} for i in range(3)]}
+        r6.output = large_output
+        site.update_record_field(r6, 'output')
+        self.assertEqual(large_output, site.load_record(r6.id).output)
+        r6.output = {'message': 'y' * _ARGV_JSON_LIMIT}
+        site.finish_record(r6)
+        self.assertEqual({'message': 'y' * _ARGV_JSON_LIMIT}, site.load_record(r6.id).output)
+
         # claim not exist
         r6 = site.claim_record('foobar')
         self.assertIsNone(r6)